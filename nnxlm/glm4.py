@@ -1,7 +1,6 @@
 import jax
-import jax.numpy as jnp
 from flax import nnx
-from .utils import apply_rope
+from .utils import apply_rope, attention
 
 class Glm4MLP(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
@@ -11,8 +10,8 @@ class Glm4MLP(nnx.Module):
     @nnx.jit
     def __call__(self, x: jax.Array):
         x = self.gate_up_proj(x)
-        gate, up_states = jnp.split(x, 2, axis=-1)
-        return self.down_proj(jax.nn.silu(gate) * up_states)
+        I = x.shape[-1] // 2
+        return self.down_proj(jax.nn.silu(x[..., :I]) * x[..., I:])
 
 class Glm4Attention(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
@@ -37,21 +36,10 @@ class Glm4Attention(nnx.Module):
         q = q.reshape(B, L, self.n_heads, self.head_dim)
         k = k.reshape(B, L, self.n_kv_heads, self.head_dim)
         v = v.reshape(B, L, self.n_kv_heads, self.head_dim)
-        q = jnp.transpose(q, (0, 2, 1, 3))
-        k = jnp.transpose(k, (0, 2, 1, 3))
-        v = jnp.transpose(v, (0, 2, 1, 3))
         q, k = apply_rope(q, k, *rope, self.rot_dims, self.rope_traditional)
         if cache is not None:
             k, v = cache(k, v)
-        if self.n_heads > self.n_kv_heads:
-            repeat_factor = self.n_heads // self.n_kv_heads
-            k = jnp.repeat(k, repeats=repeat_factor, axis=1)
-            v = jnp.repeat(v, repeats=repeat_factor, axis=1)
-        w = jnp.matmul(q, jnp.swapaxes(k, -1, -2)) * self.scale
-        w = w + attention_mask
-        w = jax.nn.softmax(w, axis=-1)
-        w = jnp.matmul(w, v)
-        w = jnp.transpose(w, (0, 2, 1, 3))
+        w = attention(q, k, v, attention_mask, self.scale, self.rot_dims)
         w = w.reshape(B, L, -1)
         return self.o_proj(w)
 
@@ -76,19 +64,20 @@ class Glm4DecoderLayer(nnx.Module):
 class Glm4Model(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
         self.embed_tokens = nnx.Embed(num_embeddings=config.vocab_size, features=config.hidden_size, rngs=rngs)
-        self.layers = [Glm4DecoderLayer(config, rngs=rngs) for _ in range(config.num_hidden_layers)]
+        @nnx.split_rngs(splits=config.num_hidden_layers)
+        @nnx.vmap(in_axes=(0,), out_axes=0)
+        def create_layers(rngs):
+            return Glm4DecoderLayer(config, rngs=rngs)
+        self.layers = create_layers(rngs)
         self.norm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, rngs=rngs)
     
     @nnx.jit
     def __call__(self, input_ids, attention_mask, rope, cache):
         x = self.embed_tokens(input_ids)
-        for i, layer in enumerate(self.layers):
-            x = layer(
-                x,
-                attention_mask=attention_mask,
-                rope=rope,
-                cache=cache[i],
-            )
+        @nnx.scan(in_axes=(nnx.Carry, 0, 0, None, None), out_axes=nnx.Carry)
+        def forward(x, layer, cache, attention_mask, rope):
+            return layer(x, attention_mask=attention_mask, rope=rope, cache=cache)
+        x = forward(x, self.layers, cache, attention_mask, rope)
         return self.norm(x)
 
 class Glm4ForCausalLM(nnx.Module):
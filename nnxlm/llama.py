@@ -1,7 +1,6 @@
 import jax
-import jax.numpy as jnp
 from flax import nnx
-from .utils import apply_rope
+from .utils import apply_rope, attention
 
 class Attention(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
@@ -10,7 +9,6 @@ class Attention(nnx.Module):
         self.num_kv_heads = config.num_key_value_heads
         self.head_dim = config.head_dim or config.hidden_size // config.num_attention_heads
         self.scale = self.head_dim ** -0.5
-        self.n_repeat = self.num_attention_heads // self.num_kv_heads
         attention_bias = config.attention_bias if hasattr(config, "attention_bias") else False
         self.q_proj = nnx.Linear(in_features=self.hidden_size, out_features=self.num_attention_heads * self.head_dim, use_bias=attention_bias, rngs=rngs)
         self.k_proj = nnx.Linear(in_features=self.hidden_size, out_features=self.num_kv_heads * self.head_dim, use_bias=attention_bias, rngs=rngs)
@@ -26,20 +24,10 @@ class Attention(nnx.Module):
         q = q.reshape(B, L, self.num_attention_heads, self.head_dim)
         k = k.reshape(B, L, self.num_kv_heads, self.head_dim)
         v = v.reshape(B, L, self.num_kv_heads, self.head_dim)
-        q = jnp.transpose(q, (0, 2, 1, 3))
-        k = jnp.transpose(k, (0, 2, 1, 3))
-        v = jnp.transpose(v, (0, 2, 1, 3))
         q, k = apply_rope(q, k, *rope)
         if cache is not None:
             k, v = cache(k, v)
-        if self.n_repeat > 1:
-            k = k.repeat(repeats=self.n_repeat, axis=1)
-            v = v.repeat(repeats=self.n_repeat, axis=1)
-        w = jnp.matmul(q, k.swapaxes(-1, -2)) * self.scale
-        w = w + attention_mask
-        w = jax.nn.softmax(w, axis=-1)
-        w = jnp.matmul(w, v)
-        w = w.transpose((0, 2, 1, 3))
+        w = attention(q, k, v, attention_mask, self.scale)
         w = w.reshape(B, L, -1)
         return self.o_proj(w)
 
@@ -77,15 +65,21 @@ class LlamaModel(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
         self.vocab_size = config.vocab_size
         self.num_hidden_layers = config.num_hidden_layers
-        self.layers = [TransformerBlock(config, rngs=rngs) for _ in range(config.num_hidden_layers)]
+        @nnx.split_rngs(splits=config.num_hidden_layers)
+        @nnx.vmap(in_axes=(0,), out_axes=0)
+        def create_layers(rngs):
+            return TransformerBlock(config, rngs=rngs)
+        self.layers = create_layers(rngs)
         self.embed_tokens = nnx.Embed(num_embeddings=config.vocab_size, features=config.hidden_size, rngs=rngs)
         self.norm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, rngs=rngs)
     
     @nnx.jit
     def __call__(self, input_ids, attention_mask, rope, cache):
         x = self.embed_tokens(input_ids)
-        for i, layer in enumerate(self.layers):
-            x = layer(x, attention_mask=attention_mask, rope=rope, cache=cache[i])
+        @nnx.scan(in_axes=(nnx.Carry, 0, 0, None, None), out_axes=nnx.Carry)
+        def forward(x, layer, cache, attention_mask, rope):
+            return layer(x, attention_mask=attention_mask, rope=rope, cache=cache)
+        x = forward(x, self.layers, cache, attention_mask, rope)
         return self.norm(x)
     
 class LlamaForCausalLM(nnx.Module):
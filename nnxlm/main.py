@@ -1,5 +1,6 @@
 from tokenizerz import Tokenizer
 import argparse
+import jax.numpy as jnp
 from .utils import generate
 from .qwen3 import Qwen3ForCausalLM
 from .qwen2 import Qwen2ForCausalLM
@@ -7,7 +8,7 @@ from .glm4 import Glm4ForCausalLM
 from .granite import GraniteForCausalLM
 from .llama import LlamaForCausalLM
 from .phi3 import Phi3ForCausalLM
-from .utils import load_config, download_repo, load_model, generate
+from .utils import load_config, download_repo, load_model, generate, quantize_model, warmup, FP8Linear, INT8Linear
 
 ARCH_MAPPING = {
     "Qwen3ForCausalLM": Qwen3ForCausalLM,
@@ -18,11 +19,23 @@ ARCH_MAPPING = {
     "Phi3ForCausalLM": Phi3ForCausalLM,
 }
 
-def load(model_id, model_dir='models'):
+QUANT_MAPPING = {
+    "fp8": FP8Linear,
+    "int8": INT8Linear,
+}
+
+KV_DTYPES = {
+    "fp8": jnp.float8_e4m3fn,
+    "int8": jnp.int8,
+}
+
+def load(model_id, model_dir='models', quantize=None):
     repo_name, model_name = model_id.split('/')
     model_dir = download_repo(repo_name, model_name, model_dir)
     config = load_config(model_dir)
     model, tokenizer = load_model(model_dir, config=config, cls= ARCH_MAPPING.get(config.architectures[0]))
+    if quantize:
+        model = quantize_model(model, QUANT_MAPPING[quantize])
     return model, tokenizer, config
 
 def test(model_id='Qwen/Qwen3-0.6B', prompts="Give me a short introduction to large language model.\n", max_new_tokens=3, use_scan=False, use_jit=False):
@@ -73,6 +86,9 @@ def cli():
     parser.add_argument("-n", "--new", type=int, default=100, help="Maximum new tokens to generate.")
     parser.add_argument("-s", "--scan", action="store_true", help="Enable scan mode.")
     parser.add_argument("-j", "--jit", action="store_true", help="Enable JIT compilation.")
+    parser.add_argument("-q", "--quantize", type=str, default=None, choices=list(QUANT_MAPPING), help="Quantize linear layer weights.")
+    parser.add_argument("--kv-quant", type=str, default=None, choices=list(KV_DTYPES), help="Quantize the KV cache.")
+    parser.add_argument("-b", "--buckets", type=int, nargs='*', help="Prompt length buckets to pad to; precompiled at startup unless --scan or --jit is set.")
     parser.add_argument("-d", "--dir", type=str, default="models", help="Directory to download/load models.")
     parser.add_argument("--no-format", dest="use_chat_template", action="store_false", help="Do not use chat template.")
     parser.add_argument("--no-stream", dest="stream", action="store_false", help="Do not stream output.")
@@ -81,7 +97,10 @@ def cli():
         args.prompts = [p.replace("\\n", "\n") for p in args.prompts]
     else:
         args.prompts = "Give me a short introduction to large language model.\n"
-    model, tokenizer, config = load(args.model_id, model_dir=args.dir)
+    model, tokenizer, config = load(args.model_id, model_dir=args.dir, quantize=args.quantize)
+    if args.buckets and not (args.scan or args.jit):
+        batch_size = 1 if isinstance(args.prompts, str) else len(args.prompts)
+        warmup(model, config, batch_size, args.buckets, args.new, kv_dtype=KV_DTYPES.get(args.kv_quant))
     s, i = generate(
         model,
         tokenizer,
@@ -91,7 +110,9 @@ def cli():
         use_chat_template=args.use_chat_template,
         stream=args.stream,
         use_scan=args.scan,
-        use_jit=args.jit
+        use_jit=args.jit,
+        kv_dtype=KV_DTYPES.get(args.kv_quant),
+        buckets=args.buckets,
     )
     # for n, (_s, _i) in enumerate(zip(s, i)):
     #     print('=== {n} ===')
@@ -1,7 +1,8 @@
+from functools import partial
 import jax
 import jax.numpy as jnp
 from flax import nnx
-from .utils import apply_rope
+from .utils import apply_rope, attention, add_rmsnorm
 
 class Attention(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
@@ -10,11 +11,10 @@ class Attention(nnx.Module):
         self.head_dim = head_dim = config.hidden_size // n_heads
         self.scale = head_dim ** -0.5
         op_size = n_heads * head_dim + 2 * (n_kv_heads * head_dim)
-        self.qkv_proj = nnx.Linear(in_features=config.hidden_size, out_features=op_size, use_bias=False, rngs=rngs)
-        self.o_proj = nnx.Linear(in_features=n_heads * head_dim, out_features=config.hidden_size, use_bias=False, rngs=rngs)
+        self.qkv_proj = nnx.Linear(in_features=config.hidden_size, out_features=op_size, use_bias=False, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
+        self.o_proj = nnx.Linear(in_features=n_heads * head_dim, out_features=config.hidden_size, use_bias=False, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
         self.rot_dims=int(self.head_dim*config.partial_rotary_factor)
 
-    @nnx.jit
     def __call__(self, x, attention_mask, rope, cache):
         B, L, _ = x.shape
         qkv = self.qkv_proj(x)
@@ -26,76 +26,67 @@ class Attention(nnx.Module):
         q = q.reshape(B, L, self.n_heads, self.head_dim)
         k = k.reshape(B, L, self.n_kv_heads, self.head_dim)
         v = v.reshape(B, L, self.n_kv_heads, self.head_dim)
-        q = jnp.transpose(q, (0, 2, 1, 3)) 
-        k = jnp.transpose(k, (0, 2, 1, 3))
-        v = jnp.transpose(v, (0, 2, 1, 3))  
         q, k = apply_rope(q, k, *rope, self.rot_dims)
         if cache is not None:
             k, v = cache(k, v)
-        if self.n_heads > self.n_kv_heads:
-            n_repeat = self.n_heads // self.n_kv_heads
-            k = k.repeat(repeats=n_repeat, axis=1)
-            v = v.repeat(repeats=n_repeat, axis=1)
-        w = jnp.matmul(q, k.swapaxes(-1, -2)) * self.scale
-        w = w + attention_mask
-        w = jax.nn.softmax(w, axis=-1)
-        w = jnp.matmul(w, v)
-        w = w.transpose((0, 2, 1, 3))
+        w = attention(q, k, v, attention_mask, self.scale, self.rot_dims)
         w = w.reshape(B, L, -1)
         return self.o_proj(w)
 
 class MLP(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
-        self.gate_up_proj = nnx.Linear(in_features=config.hidden_size, out_features=2 * config.intermediate_size, use_bias=False, rngs=rngs)
-        self.down_proj = nnx.Linear(in_features=config.intermediate_size, out_features=config.hidden_size, use_bias=False, rngs=rngs)
+        self.gate_up_proj = nnx.Linear(in_features=config.hidden_size, out_features=2 * config.intermediate_size, use_bias=False, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
+        self.down_proj = nnx.Linear(in_features=config.intermediate_size, out_features=config.hidden_size, use_bias=False, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
     
-    @nnx.jit
     def __call__(self, x: jax.Array) -> jax.Array:
         x = self.gate_up_proj(x)
-        gate, up = jnp.split(x, 2, axis=-1)
-        return self.down_proj(jax.nn.silu(gate) * up)
+        I = x.shape[-1] // 2
+        return self.down_proj(jax.nn.silu(x[..., :I]) * x[..., I:])
 
 class TransformerBlock(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
         self.self_attn = Attention(config, rngs=rngs)
         self.mlp = MLP(config, rngs=rngs)
-        self.input_layernorm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, rngs=rngs)
-        self.post_attention_layernorm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, rngs=rngs)
+        self.input_layernorm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, dtype=config.dtype, param_dtype=jnp.float32, rngs=rngs)
+        self.post_attention_layernorm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, dtype=config.dtype, param_dtype=jnp.float32, rngs=rngs)
     
-    @nnx.jit
-    def __call__(self, x, attention_mask, rope, cache=None):
-        h = self.self_attn(
-            self.input_layernorm(x),
-            attention_mask=attention_mask,
-            rope=rope,
-            cache=cache,
-        )
-        x = x + h
-        return x + self.mlp(self.post_attention_layernorm(x))
+    def __call__(self, x, delta, attention_mask, rope, cache=None):
+        x, h = add_rmsnorm(delta, x, self.input_layernorm.scale.value, self.input_layernorm.epsilon)
+        h = self.self_attn(h, attention_mask=attention_mask, rope=rope, cache=cache)
+        x, h = add_rmsnorm(h, x, self.post_attention_layernorm.scale.value, self.post_attention_layernorm.epsilon)
+        return x, self.mlp(h)
 
 class Phi3Model(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
-        self.layers = [TransformerBlock(config, rngs=rngs) for _ in range(config.num_hidden_layers)]
-        self.embed_tokens = nnx.Embed(num_embeddings=config.vocab_size, features=config.hidden_size, rngs=rngs)
-        self.norm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, rngs=rngs)
+        @nnx.split_rngs(splits=config.num_hidden_layers)
+        @nnx.vmap(in_axes=(0,), out_axes=0)
+        def create_layers(rngs):
+            return TransformerBlock(config, rngs=rngs)
+        self.layers = create_layers(rngs)
+        self.embed_tokens = nnx.Embed(num_embeddings=config.vocab_size, features=config.hidden_size, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
+        self.norm = nnx.RMSNorm(num_features=config.hidden_size, epsilon=config.rms_norm_eps, dtype=config.dtype, param_dtype=jnp.float32, rngs=rngs)
     
-    @nnx.jit
     def __call__(self, input_ids, attention_mask, rope, cache):
-        x = self.embed_tokens(input_ids)
-        for i, layer in enumerate(self.layers):
-            x = layer(x, attention_mask=attention_mask, rope=rope, cache=cache[i])
-        return self.norm(x)
+        h = self.embed_tokens(input_ids)
+        @nnx.scan(in_axes=(nnx.Carry, 0, 0, None, None), out_axes=nnx.Carry)
+        def forward(carry, layer, cache, attention_mask, rope):
+            return layer(*carry, attention_mask=attention_mask, rope=rope, cache=cache)
+        x, delta = forward((jnp.zeros(h.shape, dtype=jnp.float32), h), self.layers, cache, attention_mask, rope)
+        _, x = add_rmsnorm(delta, x, self.norm.scale.value, self.norm.epsilon)
+        return x
     
 class Phi3ForCausalLM(nnx.Module):
     def __init__(self, config, *, rngs: nnx.Rngs):
         self.tie = tie = config.tie_word_embeddings
         self.model = Phi3Model(config, rngs=rngs)
         if not tie:
-            self.lm_head = nnx.Linear(in_features=config.hidden_size, out_features=config.vocab_size, use_bias=False, rngs=rngs)
+            self.lm_head = nnx.Linear(in_features=config.hidden_size, out_features=config.vocab_size, use_bias=False, dtype=config.dtype, param_dtype=config.dtype, rngs=rngs)
     
-    @nnx.jit
-    def __call__(self, input_ids, attention_mask, rope, cache):
+    @partial(nnx.jit, static_argnames=('return_last_only',), donate_argnames=('cache',))
+    def __call__(self, input_ids, attention_mask, rope, cache, return_last_only=True):
         x = self.model(input_ids, attention_mask=attention_mask, rope=rope, cache=cache)
+        if return_last_only:
+            x = x[:, -1:, :]
         if self.tie:
             x = self.model.embed_tokens.attend(x)
         else:
@@ -0,0 +1,77 @@
+import pytest
+jax = pytest.importorskip("jax")
+import jax.numpy as jnp
+import numpy as np
+from flax import nnx
+from nnxlm.utils import rope, rope_complex, rope_real, decode_attention, dequantize, quantize, quantize_model, FP8Linear, INT8Linear
+
+B, L, H, K, D, S = 2, 5, 8, 2, 32, 12
+
+def rope_inputs(rot_dims):
+    k1, k2 = jax.random.split(jax.random.key(0))
+    x = jax.random.normal(k1, (B, L, H, D), dtype=jnp.float32)
+    positions = jnp.arange(L, dtype=jnp.float32)[None, :, None, None] + jax.random.uniform(k2, (B, 1, 1, 1)) * 100
+    freq = 1.0 / (10000.0 ** (jnp.arange(0, rot_dims // 2, dtype=jnp.float32) / (rot_dims // 2)))
+    angles = positions * freq
+    return x, jnp.cos(angles), jnp.sin(angles)
+
+@pytest.mark.parametrize("traditional", [False, True])
+def test_rope_complex_matches_real(traditional):
+    x, cos, sin = rope_inputs(D)
+    np.testing.assert_allclose(rope_complex(x, cos, sin, traditional), rope_real(x, cos, sin, traditional), rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize("traditional", [False, True])
+@pytest.mark.parametrize("rot_dims", [None, D // 2])
+def test_rope_partial(rot_dims, traditional):
+    x, cos, sin = rope_inputs(rot_dims or D)
+    out = rope(x, cos, sin, rot_dims, traditional)
+    r = rot_dims or D
+    np.testing.assert_allclose(out[..., :r], rope_real(x[..., :r], cos, sin, traditional), rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(out[..., r:], x[..., r:])
+
+def attention_inputs():
+    kq, kk, kv, km = jax.random.split(jax.random.key(1), 4)
+    q = jax.random.normal(kq, (B, 1, H, D), dtype=jnp.float32)
+    k = jax.random.normal(kk, (B, S, K, D), dtype=jnp.float32)
+    v = jax.random.normal(kv, (B, S, K, D), dtype=jnp.float32)
+    mask = jax.random.bernoulli(km, 0.7, (B, 1, 1, S)).at[..., -1].set(True)
+    return q, k, v, mask
+
+def test_decode_attention_matches_dot_product_attention():
+    q, k, v, mask = attention_inputs()
+    out = decode_attention(q, k, v, mask, D ** -0.5)
+    ref = jax.nn.dot_product_attention(q, k, v, mask=mask, scale=D ** -0.5)
+    np.testing.assert_allclose(out, ref, rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize("qdtype", [jnp.int8, jnp.float8_e4m3fn])
+@pytest.mark.parametrize("rot_dims", [None, D // 4])
+def test_quantized_decode_attention(rot_dims, qdtype):
+    q, k, v, mask = attention_inputs()
+    if rot_dims is None:
+        k_q, k_scale = quantize(k, qdtype, axis=-1)
+    else:
+        (k_rot, s_rot), (k_pass, s_pass) = quantize(k[..., :rot_dims], qdtype, axis=-1), quantize(k[..., rot_dims:], qdtype, axis=-1)
+        k_q, k_scale = jnp.concat([k_rot, k_pass], axis=-1), jnp.concat([s_rot, s_pass], axis=-1)
+    v_q, v_scale = quantize(v, qdtype, axis=-1)
+    out = decode_attention(q, (k_q, k_scale), (v_q, v_scale), mask, D ** -0.5, rot_dims)
+    ref = jax.nn.dot_product_attention(q, dequantize(k_q, k_scale, jnp.float32, rot_dims), dequantize(v_q, v_scale, jnp.float32), mask=mask, scale=D ** -0.5)
+    np.testing.assert_allclose(out, ref, rtol=1e-5, atol=1e-5)
+
+class TwoLinear(nnx.Module):
+    def __init__(self, rngs):
+        self.up = nnx.Linear(D, 4 * D, use_bias=True, rngs=rngs)
+        self.down = nnx.Linear(4 * D, D, use_bias=False, rngs=rngs)
+
+    def __call__(self, x):
+        return self.down(jax.nn.silu(self.up(x)))
+
+@pytest.mark.parametrize("cls", [FP8Linear, INT8Linear])
+def test_quantize_model(cls):
+    model = TwoLinear(nnx.Rngs(0))
+    model.up.bias.value = jax.random.normal(jax.random.key(2), model.up.bias.value.shape)
+    x = jax.random.normal(jax.random.key(3), (B, L, D), dtype=jnp.float32)
+    ref = model(x)
+    model = quantize_model(model, cls)
+    assert isinstance(model.up, cls) and isinstance(model.down, cls)
+    assert model.up.bias is not None and model.down.bias is None
+    np.testing.assert_allclose(model(x), ref, rtol=0.1, atol=0.1)
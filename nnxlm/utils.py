@@ -4,6 +4,7 @@ import functools
 import json
 import time
 import math
+import numpy as np
 import jax
 import jax.numpy as jnp
 from urllib.request import urlretrieve
@@ -135,13 +136,38 @@ def load_model(model_dir, config, cls, model_creator=None):
     else:
         graphdef, state = nnx.split(nnx.eval_shape(lambda: cls(config, rngs=nnx.Rngs(0))))
     state = dict(state.flat_state())
+    buffers = {}
+    written = {}
     for fpath in glob(f"{model_dir}/model*.safetensors"):
-        for path, val in ((k.replace("norm.weight", "norm.scale").replace("proj.weight", "proj.kernel").replace("mlp.weight", "mlp.kernel").replace("lm_head.weight", "lm_head.kernel").replace("embed_tokens.weight", "embed_tokens.embedding"), jnp.array(v, dtype=dtype).T if k.endswith('proj.weight') or k.endswith('mlp.weight') or k.endswith('lm_head.weight') else jnp.array(v, dtype=dtype)) for k, v in load_file(fpath).items()):
-            path_tuple = tuple(int(part) if part.isdigit() else part for part in path.split('.'))
-            if path_tuple in state:
-                state[path_tuple].value = val
-            else:
+        for path, val in ((k.replace("norm.weight", "norm.scale").replace("proj.weight", "proj.kernel").replace("mlp.weight", "mlp.kernel").replace("lm_head.weight", "lm_head.kernel").replace("embed_tokens.weight", "embed_tokens.embedding"), jnp.array(v, dtype=dtype).T if k.endswith('proj.weight') or k.endswith('mlp.weight') or k.endswith('lm_head.weight') else jnp.array(v, dtype=jnp.float32 if k.endswith('norm.weight') else dtype)) for k, v in load_file(fpath).items()):
+            path_tuple = key = tuple(int(part) if part.isdigit() else part for part in path.split('.'))
+            layer = proj = None
+            if key not in state:
+                idx = next((i for i, part in enumerate(key) if isinstance(part, int)), None)
+                if idx is not None:
+                    layer, key = key[idx], key[:idx] + key[idx+1:]
+            if key not in state and key[-2] in ('q_proj', 'k_proj', 'v_proj'):
+                proj, key = key[-2], key[:-2] + ('qkv_proj', key[-1])
+            if key not in state:
                 print(f'{path_tuple} missing')
+            elif layer is None and proj is None:
+                state[key].value = val
+            else:
+                if key not in buffers:
+                    buffers[key] = np.empty(state[key].value.shape, dtype=val.dtype)
+                buf = buffers[key] if layer is None else buffers[key][layer]
+                n, w = buf.shape[-1], val.shape[-1]
+                start = {None: 0, 'q_proj': 0, 'k_proj': n - 2 * w, 'v_proj': n - w}[proj]
+                buf[..., start:start + w] = np.asarray(val)
+                written.setdefault(key, set()).add((layer, proj))
+    for key, buf in buffers.items():
+        layers = range(buf.shape[0]) if any(layer is not None for layer, _ in written[key]) else [None]
+        projs = ('q_proj', 'k_proj', 'v_proj') if any(proj is not None for _, proj in written[key]) else [None]
+        unwritten = [(layer, proj) for layer in layers for proj in projs if (layer, proj) not in written[key]]
+        for piece in unwritten:
+            print(f'{key} {piece} missing')
+        if not unwritten:
+            state[key].value = jnp.asarray(buf)
     model = nnx.merge(graphdef, nnx.State.from_flat_path(state))
     model.set_attributes(dtype=dtype, param_dtype=dtype)
     tokenizer = Tokenizer(repo_name='local', model_name=model_dir)
@@ -160,7 +186,7 @@ class Roper(nnx.Module):
 
     @nnx.jit
     def __call__(self, positions):
-        positions = positions[:, None, :, None]
+        positions = positions[:, :, None, None]
         angles = positions * self.freq
         cos = jnp.cos(angles) * self.su_scale
         sin = jnp.sin(angles) * self.su_scale
@@ -195,46 +221,136 @@ class Roper(nnx.Module):
         factor = jnp.array(factor, dtype=jnp.float32)
         self.freq = nnx.Variable(1.0 / (freqs * factor))
 
-@functools.partial(jax.jit, static_argnames=['rot_dims', 'traditional'])
-def apply_rope(q, k, cos, sin, rot_dims=None, traditional=False):
-    if rot_dims is None:
-        q_rot, k_rot = q, k
-    else:
-        q_rot, q_pass = q[..., :rot_dims], q[..., rot_dims:]
-        k_rot, k_pass = k[..., :rot_dims], k[..., rot_dims:]
+def rope_complex(x, cos, sin, traditional=False):
     if traditional:
-        q_even = q_rot[..., 0::2]
-        q_odd  = q_rot[..., 1::2]
-        k_even = k_rot[..., 0::2]
-        k_odd  = k_rot[..., 1::2]
-        q_rotated = jnp.stack([(q_even * cos - q_odd * sin), (q_even * sin + q_odd * cos)], axis=-1).reshape(q_rot.shape).astype(q.dtype)
-        k_rotated = jnp.stack([(k_even * cos - k_odd * sin), (k_even * sin + k_odd * cos)], axis=-1).reshape(k_rot.shape).astype(k.dtype)
+        x_pair = x.astype(jnp.float32).reshape(*x.shape[:-1], -1, 2)
+        x_c = jax.lax.complex(x_pair[..., 0], x_pair[..., 1])
     else:
-        q_split = q_rot.reshape(*q.shape[:-1], 2, -1)
-        k_split = k_rot.reshape(*k.shape[:-1], 2, -1)
-        q_rotated = jnp.concatenate([
-            q_split[..., 0, :] * cos - q_split[..., 1, :] * sin,
-            q_split[..., 1, :] * cos + q_split[..., 0, :] * sin,
-        ], axis=-1).astype(q.dtype)
-        k_rotated = jnp.concatenate([
-            k_split[..., 0, :] * cos - k_split[..., 1, :] * sin,
-            k_split[..., 1, :] * cos + k_split[..., 0, :] * sin,
-        ], axis=-1).astype(k.dtype)
+        x_pair = x.astype(jnp.float32).reshape(*x.shape[:-1], 2, -1)
+        x_c = jax.lax.complex(x_pair[..., 0, :], x_pair[..., 1, :])
+    x_c = x_c * jax.lax.complex(cos, sin)
+    return jnp.stack([x_c.real, x_c.imag], axis=-1 if traditional else -2).reshape(x.shape).astype(x.dtype)
+
+def rope_real(x, cos, sin, traditional=False):
+    if traditional:
+        x_even = x[..., 0::2]
+        x_odd  = x[..., 1::2]
+        return jnp.stack([(x_even * cos - x_odd * sin), (x_even * sin + x_odd * cos)], axis=-1).reshape(x.shape).astype(x.dtype)
+    x_split = x.reshape(*x.shape[:-1], 2, -1)
+    return jnp.concatenate([
+        x_split[..., 0, :] * cos - x_split[..., 1, :] * sin,
+        x_split[..., 1, :] * cos + x_split[..., 0, :] * sin,
+    ], axis=-1).astype(x.dtype)
+
+def rope(x, cos, sin, rot_dims=None, traditional=False):
+    rope_fn = rope_real if jax.default_backend() == 'METAL' else rope_complex
     if rot_dims is None:
-        return q_rotated, k_rotated
+        return rope_fn(x, cos, sin, traditional)
+    return jnp.concatenate([rope_fn(x[..., :rot_dims], cos, sin, traditional), x[..., rot_dims:]], axis=-1)
+
+@functools.partial(jax.jit, static_argnames=['rot_dims', 'traditional'])
+def apply_rope(q, k, cos, sin, rot_dims=None, traditional=False):
+    return rope(q, cos, sin, rot_dims, traditional), rope(k, cos, sin, rot_dims, traditional)
+
+def rms_norm(x, scale, eps):
+    x = x.astype(jnp.float32)
+    return x * jax.lax.rsqrt(jnp.mean(jnp.square(x), axis=-1, keepdims=True) + eps) * scale
+
+def rmsnorm_rope(x, scale, eps, cos, sin, rot_dims=None, traditional=False):
+    return rope(rms_norm(x, scale, eps), cos, sin, rot_dims, traditional).astype(x.dtype)
+
+def add_rmsnorm(x, residual, scale, eps):
+    y = residual + x.astype(residual.dtype)
+    return y, rms_norm(y, scale, eps).astype(x.dtype)
+
+def dequantize(x, scale, dtype, rot_dims=None):
+    if scale.shape[-1] == 1:
+        return x.astype(dtype) * scale.astype(dtype)
+    return jnp.concat([x[..., :rot_dims].astype(dtype) * scale[..., :1].astype(dtype), x[..., rot_dims:].astype(dtype) * scale[..., 1:].astype(dtype)], axis=-1)
+
+@functools.partial(jax.jit, static_argnames=['rot_dims'])
+def decode_attention(q, k, v, attention_mask, scale, rot_dims=None):
+    B, _, H, D = q.shape
+    K = (k[0] if isinstance(k, tuple) else k).shape[2]
+    q = (q * scale).reshape(B, K, H // K, D)
+    if isinstance(k, tuple):
+        k, k_scale = k
+        k_scale = k_scale.transpose(0, 2, 3, 1)
+        k = k.astype(q.dtype)
+        if k_scale.shape[2] == 1:
+            w = jnp.einsum('bkgd,bskd->bkgs', q, k, preferred_element_type=jnp.float32) * k_scale
+        else:
+            w = jnp.einsum('bkgd,bskd->bkgs', q[..., :rot_dims], k[..., :rot_dims], preferred_element_type=jnp.float32) * k_scale[:, :, :1]
+            w = w + jnp.einsum('bkgd,bskd->bkgs', q[..., rot_dims:], k[..., rot_dims:], preferred_element_type=jnp.float32) * k_scale[:, :, 1:]
     else:
-        q_out = jnp.concatenate([q_rotated, q_pass], axis=-1)
-        k_out = jnp.concatenate([k_rotated, k_pass], axis=-1)
-        return q_out, k_out
+        w = jnp.einsum('bkgd,bskd->bkgs', q, k, preferred_element_type=jnp.float32)
+    w = jax.nn.softmax(jnp.where(attention_mask, w, jnp.finfo(jnp.float32).min), axis=-1)
+    if isinstance(v, tuple):
+        v, v_scale = v
+        w = w * v_scale.transpose(0, 2, 3, 1)
+        v = v.astype(q.dtype)
+    return jnp.einsum('bkgs,bskd->bkgd', w.astype(v.dtype), v).reshape(B, 1, H, D)
+
+def attention(q, k, v, attention_mask, scale, rot_dims=None):
+    if q.shape[1] == 1:
+        return decode_attention(q, k, v, attention_mask, scale, rot_dims)
+    if isinstance(k, tuple):
+        k = dequantize(*k, q.dtype, rot_dims)
+        v = dequantize(*v, q.dtype)
+    implementation = 'cudnn' if jax.default_backend() == 'gpu' and q.dtype in (jnp.bfloat16, jnp.float16) else None
+    return jax.nn.dot_product_attention(q, k, v, mask=attention_mask, scale=scale, implementation=implementation)
 
 @jax.jit
 def create_causal_mask(padding_mask):
-    padding_mask = jnp.array(padding_mask)
+    padding_mask = jnp.array(padding_mask, dtype=bool)
     seq_length = padding_mask.shape[1]
     causal_matrix = jnp.tril(jnp.ones((seq_length, seq_length), dtype=bool))
-    causal_mask = jnp.where(causal_matrix & padding_mask[:, None, :], 0.0, -1e4)
+    causal_mask = causal_matrix & padding_mask[:, None, :]
     return causal_mask[:, None, :, :]
 
+@functools.partial(jax.jit, static_argnames=['qdtype', 'axis'])
+def quantize(x, qdtype, axis):
+    is_int = jnp.issubdtype(qdtype, jnp.integer)
+    qmax = float(jnp.iinfo(qdtype).max if is_int else jnp.finfo(qdtype).max)
+    x = x.astype(jnp.float32)
+    scale = jnp.maximum(jnp.max(jnp.abs(x), axis=axis, keepdims=True), 1e-12) / qmax
+    x = x / scale
+    if is_int:
+        x = jnp.round(x)
+    return x.astype(qdtype), scale
+
+class QuantLinear(nnx.Module):
+    qdtype = None
+    scale_dtype = None
+
+    def __init__(self, linear):
+        scale_dtype = linear.kernel.value.dtype if self.scale_dtype is None else self.scale_dtype
+        kernel, scale = quantize(linear.kernel.value, self.qdtype, axis=-2)
+        self.kernel = nnx.Param(kernel)
+        self.scale = nnx.Param(scale.astype(scale_dtype))
+        self.bias = linear.bias
+
+    def __call__(self, x):
+        y = jax.lax.dot_general(x, self.kernel.value.astype(x.dtype), (((x.ndim - 1,), (0,)), ((), ())), preferred_element_type=x.dtype)
+        y = y * self.scale.value.astype(y.dtype)
+        if self.bias is not None:
+            y = y + self.bias.value.astype(y.dtype)
+        return y
+
+class FP8Linear(QuantLinear):
+    qdtype = jnp.float8_e4m3fn
+    scale_dtype = jnp.float32
+
+class INT8Linear(QuantLinear):
+    qdtype = jnp.int8
+
+def quantize_model(model, cls):
+    for _, module in list(model.iter_modules()):
+        for name, value in list(vars(module).items()):
+            if isinstance(value, nnx.Linear):
+                setattr(module, name, cls(value))
+    return model
+
 def measure_performance(start_time, prompt_time, end_time, batch_size, seq_length, gen_length):
     prompt_duration = prompt_time - start_time
     generation_duration = end_time - prompt_time
@@ -256,17 +372,66 @@ def measure_performance(start_time, prompt_time, end_time, batch_size, seq_lengt
     return metrics
 
 class Cache(nnx.Module):
-    def __init__(self, dtype, batch_size, num_heads, max_len, head_dim, k=None, v=None):
+    def __init__(self, dtype, batch_size, num_heads, max_len, head_dim, k=None, v=None, num_layers=None):
         self.max_len = max_len
-        self.k = nnx.Variable(jnp.zeros((batch_size, num_heads, max_len, head_dim), dtype=dtype)) if k is None else nnx.Variable(k)
-        self.v = nnx.Variable(jnp.zeros((batch_size, num_heads, max_len, head_dim), dtype=dtype)) if v is None else nnx.Variable(v)
+        shape = (batch_size, max_len, num_heads, head_dim) if num_layers is None else (num_layers, batch_size, max_len, num_heads, head_dim)
+        self.k = nnx.Variable(jnp.zeros(shape, dtype=dtype)) if k is None else nnx.Variable(k)
+        self.v = nnx.Variable(jnp.zeros(shape, dtype=dtype)) if v is None else nnx.Variable(v)
 
     @nnx.jit
     def __call__(self, k, v):
-        self.k.value = jnp.concat([self.k.value, k], axis=2)[:,:,-self.max_len:,:]
-        self.v.value = jnp.concat([self.v.value, v], axis=2)[:,:,-self.max_len:,:]
+        self.k.value = jnp.concat([self.k.value, k], axis=1)[:,-self.max_len:]
+        self.v.value = jnp.concat([self.v.value, v], axis=1)[:,-self.max_len:]
         return self.k.value, self.v.value
 
+class QuantCache(Cache):
+    def __init__(self, dtype, batch_size, num_heads, max_len, head_dim, kv_dtype=jnp.int8, rot_dims=None, num_layers=None):
+        super().__init__(kv_dtype, batch_size, num_heads, max_len, head_dim, num_layers=num_layers)
+        self.rot_dims = None if rot_dims == head_dim else rot_dims
+        shape = self.k.value.shape[:-1]
+        self.k_scale = nnx.Variable(jnp.zeros((*shape, 1 if self.rot_dims is None else 2), dtype=jnp.float32))
+        self.v_scale = nnx.Variable(jnp.zeros((*shape, 1), dtype=jnp.float32))
+
+    def _quantize(self, x, rot_dims):
+        if rot_dims is None:
+            return quantize(x, self.k.value.dtype, axis=-1)
+        x_rot, s_rot = quantize(x[..., :rot_dims], self.k.value.dtype, axis=-1)
+        x_pass, s_pass = quantize(x[..., rot_dims:], self.k.value.dtype, axis=-1)
+        return jnp.concat([x_rot, x_pass], axis=-1), jnp.concat([s_rot, s_pass], axis=-1)
+
+    @nnx.jit
+    def __call__(self, k, v):
+        k, k_scale = self._quantize(k, self.rot_dims)
+        v, v_scale = self._quantize(v, None)
+        self.k.value = jnp.concat([self.k.value, k], axis=1)[:,-self.max_len:]
+        self.v.value = jnp.concat([self.v.value, v], axis=1)[:,-self.max_len:]
+        self.k_scale.value = jnp.concat([self.k_scale.value, k_scale], axis=1)[:,-self.max_len:]
+        self.v_scale.value = jnp.concat([self.v_scale.value, v_scale], axis=1)[:,-self.max_len:]
+        return (self.k.value, self.k_scale.value), (self.v.value, self.v_scale.value)
+
+def create_cache(config, batch_size, max_len, kv_dtype=None):
+    if kv_dtype is None:
+        return Cache(config.dtype, batch_size, config.num_key_value_heads, max_len, config.head_dim, num_layers=config.num_hidden_layers)
+    rot_dims = int(config.head_dim * config.partial_rotary_factor)
+    return QuantCache(config.dtype, batch_size, config.num_key_value_heads, max_len, config.head_dim, kv_dtype=kv_dtype, rot_dims=rot_dims, num_layers=config.num_hidden_layers)
+
+def pad_to_bucket(input_ids, position_ids, padding_mask, buckets):
+    L = input_ids.shape[1]
+    pad = min((b for b in buckets if b >= L), default=L) - L
+    input_ids = jnp.pad(input_ids, ((0, 0), (pad, 0)))
+    position_ids = jnp.pad(position_ids, ((0, 0), (pad, 0)))
+    padding_mask = jnp.pad(jnp.array(padding_mask, dtype=bool), ((0, 0), (pad, 0)))
+    return input_ids, position_ids, padding_mask
+
+def warmup(model, config, batch_size, buckets, max_new_tokens, kv_dtype=None):
+    for L in buckets:
+        total_len = L + max_new_tokens
+        roper = Roper(config, total_len)
+        cache = create_cache(config, batch_size, total_len, kv_dtype)
+        causal_mask = jnp.ones((batch_size, 1, L, total_len), dtype=bool)
+        model(jnp.zeros((batch_size, L), dtype=jnp.int32), causal_mask, roper(jnp.zeros((batch_size, L), dtype=jnp.float32)), cache)
+        model(jnp.zeros((batch_size, 1), dtype=jnp.int32), causal_mask[:, :, -1:, :], roper(jnp.zeros((batch_size, 1), dtype=jnp.float32)), cache)
+
 def generate(
     model,
     tokenizer,
@@ -279,6 +444,8 @@ def generate(
     stream = True,
     use_scan = False,
     use_jit = False,
+    kv_dtype = None,
+    buckets = None,
     **kwargs
 ):
     if isinstance(prompts, str):
@@ -293,14 +460,17 @@ def generate(
     # input_str, input_ids, position_ids, padding_mask = tokenizer(prompts, use_chat_template=use_chat_template, strftime_now=strftime_now, **kwargs)
     input_str, input_ids, position_ids, padding_mask = tokenizer(prompts)
     input_ids = jnp.array(input_ids, dtype=jnp.int32)
-    B, L = input_ids.shape
     position_ids = jnp.array(position_ids, dtype=jnp.float32)
+    prompt_len = input_ids.shape[1]
+    if buckets:
+        input_ids, position_ids, padding_mask = pad_to_bucket(input_ids, position_ids, padding_mask, buckets)
+    B, L = input_ids.shape
     total_len = max_new_tokens + L
-    roper = Roper(config, total_len)
-    causal_mask = create_causal_mask(padding_mask).astype(config.dtype)
-    causal_mask = jnp.pad(causal_mask, ((0,0), (0,0), (0,0), (max_new_tokens,0)), 'constant', constant_values=-1e4).astype(config.dtype)
-    cache = [Cache(config.dtype, B, config.num_key_value_heads, total_len, config.head_dim) for _ in range(config.num_hidden_layers)]
-    zeropad = jnp.zeros((B, 1, 1, 1), dtype=config.dtype)
+    roper = Roper(config, max_new_tokens + prompt_len)
+    causal_mask = create_causal_mask(padding_mask)
+    causal_mask = jnp.pad(causal_mask, ((0,0), (0,0), (0,0), (max_new_tokens,0)), 'constant', constant_values=False)
+    cache = create_cache(config, B, total_len, kv_dtype)
+    newpad = jnp.ones((B, 1, 1, 1), dtype=bool)
     goon = jnp.ones((B, 1), dtype=bool)
     eos_id = config.eos_token_id if isinstance(config.eos_token_id, int) else config.eos_token_id[0] # ad hoc
     start_tic = time.perf_counter()
@@ -310,7 +480,7 @@ def generate(
         logits = model(input_ids, causal_mask, rope, cache)
         next_input_ids = jnp.argmax(logits[:, -1, :], axis=-1, keepdims=True)
         next_input_ids = jnp.where(goon, next_input_ids, eos_id)
-        new_mask = jnp.concat([causal_mask[:, :, -1:, :], zeropad], axis=-1)[:,:,:,1:]
+        new_mask = jnp.concat([causal_mask[:, :, -1:, :], newpad], axis=-1)[:,:,:,1:]
         goon = goon & (next_input_ids != eos_id)
         next_position_ids = position_ids[:, -1:] + 1
         new_carry = (next_input_ids, next_position_ids, new_mask, cache, goon)
@@ -344,5 +514,5 @@ def generate(
         o_str = tokenizer.decode(o_ids)
         output_str.append(o_str)
         print(f'\n=== Input ===\n{i_str}\n=== Output===\n{o_str}\n')
-    measure_performance(start_tic, prompt_tic, end_tic, B, L, max_new_tokens)
+    measure_performance(start_tic, prompt_tic, end_tic, B, prompt_len, max_new_tokens)
     return output_str, output_ids